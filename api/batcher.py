@@ -0,0 +1,89 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, List
+
+
+class MicroBatcher:
+    """短い時間窓に届いたリクエストをまとめて 1 回の呼び出しで処理するコアレッサ。
+
+    submit() は (payload, future) をキューに積み、バックグラウンドのワーカーが最大 max_size 件
+    または window 秒まで待って取り出します。1 件だけなら single_fn、複数なら batch_fn を呼び、
+    結果を各 future に振り分けます。ワーカーは最初の submit() 時にそのイベントループ上で起動します。
+    """
+
+    def __init__(
+        self,
+        single_fn: Callable[[Any], Awaitable[Any]],
+        batch_fn: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_size: int,
+        window: float,
+    ):
+        self.single_fn = single_fn
+        self.batch_fn = batch_fn
+        self.max_size = int(max_size)
+        self.window = float(window)
+        self.queue = None
+        self.worker = None
+        self.loop = None
+        self.inflight = set()
+
+    async def submit(self, payload: Any) -> Any:
+        # まとめる相手がいない設定ならキューを通さず即座に呼ぶ
+        if self.max_size <= 1:
+            return await self.single_fn(payload)
+        self._ensure_worker()
+        fut = self.loop.create_future()
+        self.queue.put_nowait((payload, fut))
+        return await fut
+
+    def _ensure_worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done() or self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.worker = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 呼び出し中も次の窓の収集を続けられるよう、別タスクで実行する
+            task = self.loop.create_task(self._dispatch(batch))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def _dispatch(self, batch: List[tuple]) -> None:
+        try:
+            if len(batch) == 1:
+                results = [await self.single_fn(batch[0][0])]
+            else:
+                results = await self.batch_fn([payload for payload, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(
+                    f"batch_fn returned {len(results)} results for {len(batch)} requests"
+                )
+            for (_, fut), result in zip(batch, results):
+                if not fut.done():
+                    fut.set_result(result)
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+        finally:
+            # キャンセル等で結果を配れなかった場合も、待機中のリクエストを取り残さない
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(RuntimeError("batch dispatch did not complete"))
+
+
+# 環境変数で設定（BATCH_MAX_SIZE=1 でバッチ化を無効化）
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "4"))
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW_MS", "75")) / 1000
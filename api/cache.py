@@ -0,0 +1,117 @@
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Sequence
+
+import diskcache
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticCache:
+    """埋め込みベクトルのコサイン類似度で、言い回しだけが違うリクエストの結果を再利用する LRU。
+
+    partition（都道府県・市区町村・業種・件数など）は完全一致を条件とし、その中で
+    キーワードの表記揺れだけを類似度で吸収します。完全一致キャッシュと同じく、保存から
+    ttl 秒を過ぎたエントリは使いません。単一プロセス向けです。
+    """
+
+    def __init__(self, maxsize: int, threshold: float, ttl: float):
+        self.maxsize = int(maxsize)
+        self.threshold = float(threshold)
+        self.ttl = float(ttl)
+        # key -> (partition, 単位ベクトル, value, 保存時刻 [time.monotonic()])
+        self.entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vec: Sequence[float]) -> np.ndarray:
+        v = np.asarray(vec, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def lookup(self, partition: Hashable, vec: Sequence[float]) -> Optional[Any]:
+        """同じ partition 内で類似度が threshold 以上の最も近いエントリの値を返す（無ければ None）。"""
+        q = self._unit(vec)
+        cutoff = time.monotonic() - self.ttl
+        with self.lock:
+            keys = [k for k, (p, _, _, ts) in self.entries.items() if p == partition and ts > cutoff]
+            if not keys:
+                return None
+            sims = np.stack([self.entries[k][1] for k in keys]) @ q
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                return None
+            key = keys[best]
+            self.entries.move_to_end(key)
+            return self.entries[key][2]
+
+    def store(self, key: Hashable, partition: Hashable, vec: Sequence[float], value: Any) -> None:
+        now = time.monotonic()
+        with self.lock:
+            # 期限切れのエントリを先に取り除く
+            for k in [k for k, e in self.entries.items() if e[3] <= now - self.ttl]:
+                del self.entries[k]
+            self.entries[key] = (partition, self._unit(vec), value, now)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+
+# 環境変数で設定（SEMANTIC_CACHE_THRESHOLD=0 で意味的キャッシュを無効化）
+CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256"))
+CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "3600"))
+SEMANTIC_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_ENABLED = SEMANTIC_THRESHOLD > 0
+_semantic = SemanticCache(CACHE_SIZE, SEMANTIC_THRESHOLD, CACHE_TTL)
+
+
+def semantic_lookup(partition: Hashable, vec: Sequence[float]) -> Optional[Any]:
+    return _semantic.lookup(partition, vec)
+
+
+def semantic_store(key: Hashable, partition: Hashable, vec: Sequence[float], value: Any) -> None:
+    _semantic.store(key, partition, vec, value)
+
+
+# 再デプロイやコールドスタートをまたいで結果を残すディスク上の KV（DISK_CACHE_DIR を空にすると無効）
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", "/tmp/subsidy_cache")
+DISK_CACHE_TTL = float(os.getenv("DISK_CACHE_TTL", "86400"))
+_disk = None
+if DISK_CACHE_DIR:
+    try:
+        # 複数ワーカーの同時書き込みで長く待たないよう SQLite のロック待ちは短くする
+        _disk = diskcache.Cache(DISK_CACHE_DIR, size_limit=256 << 20, timeout=1)
+    except Exception as e:
+        logger.warning("Disk cache unavailable at %s: %s", DISK_CACHE_DIR, e)
+
+
+def request_key(fields: dict) -> str:
+    """リクエスト内容（キー順に依存しない）の BLAKE2b ハッシュ。"""
+    return hashlib.blake2b(orjson.dumps(fields, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+async def disk_get(key: str) -> Optional[Any]:
+    """SQLite へのアクセスはイベントループを止めないようスレッドで行う。"""
+    if _disk is None:
+        return None
+    try:
+        return await asyncio.to_thread(_disk.get, key)
+    except Exception as e:
+        logger.warning("Disk cache read failed: %s", e)
+        return None
+
+
+async def disk_set(key: str, value: Any) -> None:
+    if _disk is None:
+        return
+    try:
+        await asyncio.to_thread(_disk.set, key, value, expire=DISK_CACHE_TTL)
+    except Exception as e:
+        logger.warning("Disk cache write failed: %s", e)
@@ -1,17 +1,22 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import Field
 from typing import Optional, List
 from .schemas import SearchRequest, GrantItem, SearchResponse
 from . import utils
 from . import rate_limiter
+from . import cache
+from . import batcher
 import os, time
-from openai import OpenAI
-import asyncio
+import copy
+import orjson
+from openai import AsyncOpenAI, BadRequestError, DefaultAioHttpClient
+from async_lru import alru_cache
 import re
-import json
 import logging
-import traceback
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Subsidy API")
 
@@ -28,7 +33,7 @@ async def simple_rate_limit_middleware(request, call_next):
     except Exception:
         client_ip = "unknown"
 
-    allowed, remaining = rate_limiter.allow_request(client_ip)
+    allowed, remaining = await rate_limiter.allow_request(client_ip)
     if not allowed:
         from fastapi.responses import JSONResponse
         return JSONResponse(status_code=429, content={"detail": "Too Many Requests"}, headers={"X-RateLimit-Remaining": str(remaining)})
@@ -52,22 +57,33 @@ app.add_middleware(
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4.1-mini")
 OPENAI_URL = "https://api.openai.com/v1/responses"
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+# 構造化出力（json_schema）を使わない場合は 0 にする（API に拒否された場合もプロセス内で自動的に無効化する）
+OPENAI_STRUCTURED_OUTPUT = os.getenv("OPENAI_STRUCTURED_OUTPUT", "1") != "0"
 
 if not OPENAI_API_KEY:
     print("[WARN] OPENAI_API_KEY is not set. /v1/search will fail.")
 
+# Use official OpenAI SDK to avoid parameter mismatches across API versions
+# 接続プール（TLS セッション含む）をリクエスト間で使い回すため、クライアントは1つだけ作る。
+# 高並列時に httpx の既定トランスポートがボトルネックになるため aiohttp トランスポートを使う
+# （aiohttp のセッションは初回リクエスト時にイベントループ上で作られる）。
+_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=DefaultAioHttpClient(timeout=OPENAI_TIMEOUT),
+) if OPENAI_API_KEY else None
+
 # ========= プロンプト & スキーマ =========
-def build_prompt(req: SearchRequest) -> str:
-        return f"""
-あなたは日本の助成金・補助金の調査員です。
-必ず一次情報（自治体/省庁/公的団体の公式ページ）を優先し、下記条件に合う案件を上位{req.top_k}件返してください。
+# 定数部分はインポート時に一度だけ組み立て、リクエストごとには可変部分だけを埋め込む
+_PROMPT_HEAD = """あなたは日本の助成金・補助金の調査員です。
+必ず一次情報（自治体/省庁/公的団体の公式ページ）を優先し、下記条件に合う案件を上位{top_k}件返してください。
 金額・補助率・締切は出典に記載がある範囲のみ。憶測で作らない。要約は200字以内。
 
 条件:
-- 都道府県: {req.prefecture}
-- 市区町村: {req.municipality or '指定なし'}
-- 業種: {req.industry or '指定なし'}
-- 追加キーワード: {req.keywords or '指定なし'}
+"""
+
+_PROMPT_TAIL = """
 
 返却は必ず厳密なJSONで、キー名は title, summary, source_url, grant_type, confidence, deadline, amount_max, rate_max, area, municipality, industry, reasons の順で出力してください。
 source_url は必ず一次情報（公式のURL）を入れてください。
@@ -94,69 +110,189 @@ confidence は 0.0〜1.0 の数値で、情報の信頼度を示してくださ
         }}
     ]
 }}
-```
-""".strip()
-
-def build_json_schema():
-    return {
-        "name": "GrantSearchResult",
-        "schema": {
-            "type": "object",
-            "additionalProperties": False,
-            "required": ["items"],
-            "properties": {
+```"""
+
+_PROMPT_TEMPLATE = _PROMPT_HEAD + "{vars}" + _PROMPT_TAIL
+
+_BATCH_PROMPT_TEMPLATE = """あなたは日本の助成金・補助金の調査員です。
+必ず一次情報（自治体/省庁/公的団体の公式ページ）を優先し、下記の各検索条件について、条件に合う案件をそれぞれ指定件数返してください。
+金額・補助率・締切は出典に記載がある範囲のみ。憶測で作らない。要約は200字以内。
+
+検索条件:
+{queries}
+
+返却は必ず厳密なJSONで、検索条件ごとに query_id と items を返してください。
+items の各要素のキー名は title, summary, source_url, grant_type, confidence, deadline, amount_max, rate_max, area, municipality, industry, reasons の順で出力してください。
+source_url は必ず一次情報（公式のURL）を入れてください。
+grant_type は「補助金」または「助成金」のいずれかを明記してください。
+confidence は 0.0〜1.0 の数値で、情報の信頼度を示してください。
+
+例（必ずこの形式に従う）:
+```json
+{{
+    "batch": [
+        {{
+            "query_id": "q0",
+            "items": [
+                {{
+                    "title": "助成金A",
+                    "summary": "〜200字以内の要約",
+                    "source_url": "https://www.example.go.jp/...",
+                    "grant_type": "助成金",
+                    "confidence": 0.85,
+                    "deadline": "2025-12-31",
+                    "amount_max": 1000000,
+                    "rate_max": 0.5,
+                    "area": "東京都",
+                    "municipality": "渋谷区",
+                    "industry": "情報通信業",
+                    "reasons": ["一次情報に基づく記載あり"]
+                }}
+            ]
+        }}
+    ]
+}}
+```"""
+
+def build_prompt(req: SearchRequest) -> str:
+    vars_block = "\n".join((
+        f"- 都道府県: {req.prefecture}",
+        f"- 市区町村: {req.municipality or '指定なし'}",
+        f"- 業種: {req.industry or '指定なし'}",
+        f"- 追加キーワード: {req.keywords or '指定なし'}",
+    ))
+    return _PROMPT_TEMPLATE.format(top_k=req.top_k, vars=vars_block)
+
+def build_batch_prompt(reqs: List[SearchRequest]) -> str:
+    """複数の検索条件を1回の呼び出しで処理するためのプロンプト（query_id は q0, q1, ...）。"""
+    queries = "\n".join(
+        f"- query_id: q{n} / 都道府県: {r.prefecture} / 市区町村: {r.municipality or '指定なし'}"
+        f" / 業種: {r.industry or '指定なし'} / 追加キーワード: {r.keywords or '指定なし'} / 件数: 上位{r.top_k}件"
+        for n, r in enumerate(reqs)
+    )
+    return _BATCH_PROMPT_TEMPLATE.format(queries=queries)
+
+# スキーマは定数なのでインポート時に一度だけ組み立てる。
+# strict モードでは全プロパティを required にする必要がある（省略可能な項目は null を許可）
+_JSON_SCHEMA = {
+    "name": "GrantSearchResult",
+    "schema": {
+        "type": "object",
+        "additionalProperties": False,
+        "required": ["items"],
+        "properties": {
+            "items": {
+                "type": "array",
+                "maxItems": 20,
                 "items": {
-                    "type": "array",
-                    "maxItems": 20,
-                    "items": {
-                        "type": "object",
-                        "additionalProperties": False,
-                        "required": ["title", "summary", "source_url", "grant_type", "confidence"],
-                        "properties": {
-                            "title": {"type": "string", "maxLength": 160},
-                            "summary": {"type": "string", "maxLength": 220},
-                            "source_url": {"type": "string"},
-                            "grant_type": {"type": "string", "enum": ["補助金", "助成金"]},
-                            "deadline": {"type": ["string", "null"]},
-                            "amount_max": {"type": ["integer", "null"], "minimum": 0},
-                            "rate_max": {"type": ["number", "null"], "minimum": 0, "maximum": 1},
-                            "area": {"type": ["string", "null"]},
-                            "municipality": {"type": ["string", "null"]},
-                            "industry": {"type": ["string", "null"]},
-                            "confidence": {"type": "number", "minimum": 0, "maximum": 1},
-                            "reasons": {
-                                "type": "array", "items": {"type": "string"}, "maxItems": 3
-                            }
+                    "type": "object",
+                    "additionalProperties": False,
+                    "required": [
+                        "title", "summary", "source_url", "grant_type", "deadline", "amount_max",
+                        "rate_max", "area", "municipality", "industry", "confidence", "reasons",
+                    ],
+                    "properties": {
+                        "title": {"type": "string"},
+                        "summary": {"type": "string"},
+                        "source_url": {"type": "string"},
+                        "grant_type": {"type": "string", "enum": ["補助金", "助成金"]},
+                        "deadline": {"type": ["string", "null"]},
+                        "amount_max": {"type": ["integer", "null"], "minimum": 0},
+                        "rate_max": {"type": ["number", "null"], "minimum": 0, "maximum": 1},
+                        "area": {"type": ["string", "null"]},
+                        "municipality": {"type": ["string", "null"]},
+                        "industry": {"type": ["string", "null"]},
+                        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+                        "reasons": {
+                            "type": "array", "items": {"type": "string"}, "maxItems": 3
                         }
                     }
                 }
             }
         }
     }
+}
 
-async def call_openai(prompt: str, top_k: int):
+_BATCH_JSON_SCHEMA = {
+    "name": "GrantSearchBatchResult",
+    "schema": {
+        "type": "object",
+        "additionalProperties": False,
+        "required": ["batch"],
+        "properties": {
+            "batch": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "additionalProperties": False,
+                    "required": ["query_id", "items"],
+                    "properties": {
+                        "query_id": {"type": "string"},
+                        "items": copy.deepcopy(_JSON_SCHEMA["schema"]["properties"]["items"]),
+                    }
+                }
+            }
+        }
+    }
+}
+
+def build_text_format(json_schema: dict):
+    """Responses API の text パラメータ（構造化出力）。無効化設定時は None。"""
+    if not OPENAI_STRUCTURED_OUTPUT:
+        return None
+    return {"format": {"type": "json_schema", "strict": True, **json_schema}}
+
+_TEXT_FORMAT = build_text_format(_JSON_SCHEMA)
+_BATCH_TEXT_FORMAT = build_text_format(_BATCH_JSON_SCHEMA)
+
+# 構造化出力が API に拒否され、指定なしでの再試行が成功したら、以降このプロセスでは送らない
+_structured_output_ok = OPENAI_STRUCTURED_OUTPUT
+
+def _use_text_format(text_format) -> bool:
+    return bool(text_format) and _structured_output_ok
+
+def _disable_structured_output(e: Exception) -> None:
+    global _structured_output_ok
+    if _structured_output_ok:
+        logger.warning("Structured output rejected by the API; disabling it for this process: %s", e)
+    _structured_output_ok = False
+
+def parse_model_json(text: str):
+    """構造化出力ならそのまま1回でパースし、失敗時（旧モデル等）のみ抽出器にフォールバックする。"""
+    if _structured_output_ok:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return utils.extract_json_from_text(text)
+
+async def _create_response(prompt: str, max_output_tokens: int, metadata: dict, text_format=None):
     if not OPENAI_API_KEY:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not set")
-    # Use official OpenAI SDK to avoid parameter mismatches across API versions
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
-    def sync_call():
-        # Do not request structured schema via text to avoid Unknown parameter errors.
-        return client.responses.create(
-            model=OPENAI_MODEL,
-            tools=[{"type": "web_search"}],
-            input=prompt,
-            max_output_tokens=1800,
-            metadata={"top_k_hint": str(top_k)},
-        )
 
+    kwargs = dict(
+        model=OPENAI_MODEL,
+        tools=[{"type": "web_search"}],
+        input=prompt,
+        max_output_tokens=max_output_tokens,
+        metadata=metadata,
+    )
     try:
-        resp = await asyncio.to_thread(sync_call)
+        if not _use_text_format(text_format):
+            return await _client.responses.create(**kwargs)
+        try:
+            return await _client.responses.create(text=text_format, **kwargs)
+        except BadRequestError as e:
+            # 構造化出力（text パラメータ）に未対応の場合に備え、指定なしで1回だけ再試行する
+            logger.warning("OpenAI rejected structured output, retrying without it: %s", e)
+            resp = await _client.responses.create(**kwargs)
+            _disable_structured_output(e)
+            return resp
     except Exception as e:
-        tb = traceback.format_exc()
-        logging.error("OpenAI call failed: %s\n%s", e, tb)
+        logger.exception("OpenAI call failed: %s", e)
         raise HTTPException(status_code=502, detail=f"OpenAI call failed: {e}")
 
+def _output_text(resp) -> str:
     # Extract text output from response (support multiple SDK shapes)
     text = getattr(resp, "output_text", None)
     if not text:
@@ -178,20 +314,21 @@ async def call_openai(prompt: str, top_k: int):
             text = None
 
     if not text:
-        logging.error("No output text from OpenAI response: %s", repr(resp))
+        logger.error("No output text from OpenAI response: %r", resp)
         raise HTTPException(status_code=502, detail="OpenAI returned no text output")
+    return text
+
+async def call_openai(prompt: str, top_k: int):
+    resp = await _create_response(prompt, 1800, {"top_k_hint": str(top_k)}, _TEXT_FORMAT)
+    text = _output_text(resp)
 
     # Extract JSON from model output (support fenced blocks and arrays/objects)
-    parsed_json = None
-    try:
-        parsed_json = json.loads(text)
-    except Exception:
-        parsed_json = utils.extract_json_from_text(text)
+    parsed_json = parse_model_json(text)
 
     # パースに失敗した場合は、プロンプトを変更せずサーバ側の方針で
     # 常に空の結果に変換して返します（HTTP 502 を返さない）。
     if parsed_json is None:
-        logging.info("Model output was not JSON — returning empty items. Snippet: %s", (text or "")[:1000])
+        logger.info("Model output was not JSON — returning empty items. Snippet: %s", (text or "")[:1000])
         return []
 
     # Accept either {"items": [...]} or a bare list [...] returned by the model.
@@ -201,12 +338,155 @@ async def call_openai(prompt: str, top_k: int):
     elif isinstance(parsed_json, list):
         items_list = parsed_json
     else:
-        logging.error("Parsed JSON missing items or wrong shape: %s", parsed_json)
+        logger.error("Parsed JSON missing items or wrong shape: %r", parsed_json)
         raise HTTPException(status_code=502, detail="Unexpected OpenAI response (no items)")
 
     filtered = utils.normalize_and_filter_items(items_list, top_k)
     return filtered
 
+async def call_openai_batch(reqs: List[SearchRequest]):
+    """複数の検索条件を1回の呼び出しで処理し、reqs と同じ順で結果のリストを返す。"""
+    resp = await _create_response(
+        build_batch_prompt(reqs), 1800 * len(reqs), {"batch_size": str(len(reqs))},
+        _BATCH_TEXT_FORMAT,
+    )
+    text = _output_text(resp)
+    parsed_json = parse_model_json(text)
+
+    # 単発呼び出しと同じ方針で、パース失敗時は全件空の結果にする
+    if parsed_json is None:
+        logger.info("Model output was not JSON — returning empty items. Snippet: %s", (text or "")[:1000])
+        return [[] for _ in reqs]
+
+    if not (isinstance(parsed_json, dict) and isinstance(parsed_json.get("batch"), list)):
+        logger.error("Parsed JSON missing batch or wrong shape: %r", parsed_json)
+        raise HTTPException(status_code=502, detail="Unexpected OpenAI response (no batch)")
+
+    by_id = {
+        b.get("query_id"): b.get("items") or []
+        for b in parsed_json["batch"] if isinstance(b, dict)
+    }
+    return [
+        utils.normalize_and_filter_items(by_id.get(f"q{n}", []), r.top_k)
+        for n, r in enumerate(reqs)
+    ]
+
+async def _call_openai_single(req: SearchRequest):
+    return await call_openai(build_prompt(req), req.top_k)
+
+# 同時に届いた検索を1回の Responses 呼び出しにまとめる
+_batcher = batcher.MicroBatcher(
+    _call_openai_single, call_openai_batch, batcher.BATCH_MAX_SIZE, batcher.BATCH_WINDOW
+)
+
+async def stream_openai(prompt: str, top_k: int):
+    """モデル出力をストリーミングで受け取り、items の要素が閉じるたびに GrantItem として検証して yield する。
+
+    上流への接続と後始末は同じ async with の中で行うため、このジェネレータが一度も
+    開始されなかった場合（クライアントの早期切断など）は接続自体が作られない。
+    レスポンス開始後はステータスを変えられないので、失敗時はログを残してストリームを終える。
+    source_url が空の要素は送らず、top_k 件に達した時点でストリームを閉じる。
+    """
+    kwargs = dict(
+        model=OPENAI_MODEL,
+        tools=[{"type": "web_search"}],
+        input=prompt,
+        max_output_tokens=1800,
+        metadata={"top_k_hint": str(top_k)},
+    )
+    parser = utils.IncrementalItemParser()
+    sent = 0
+    # 構造化出力が拒否された場合（接続開始時の 400）に限り、text なしで1回だけ再試行する
+    attempts = [True, False] if _use_text_format(_TEXT_FORMAT) else [False]
+    rejected = None
+    for with_text in attempts:
+        opened = False
+        extra = {"text": _TEXT_FORMAT} if with_text else {}
+        try:
+            async with _client.responses.stream(**kwargs, **extra) as stream:
+                opened = True
+                if rejected is not None:
+                    _disable_structured_output(rejected)
+                async for event in stream:
+                    if event.type != "response.output_text.delta":
+                        continue
+                    for raw in parser.feed(event.delta):
+                        item = utils.to_grant_item(utils.normalize_item(raw))
+                        if item is None or not item.source_url:
+                            continue
+                        yield item
+                        sent += 1
+                        if sent >= top_k:
+                            return
+            return
+        except BadRequestError as e:
+            if with_text and not opened:
+                logger.warning("OpenAI rejected structured output, retrying without it: %s", e)
+                rejected = e
+                continue
+            logger.exception("OpenAI stream failed: %s", e)
+            return
+        except Exception as e:
+            logger.exception("OpenAI stream failed: %s", e)
+            return
+
+# ========= キャッシュ =========
+# 永続キャッシュのキーに含める版数。プロンプト・スキーマ・正規化の仕様を変えたら上げる
+_RESULT_CACHE_VERSION = 1
+
+async def embed_text(text: str):
+    """意味的キャッシュ用の埋め込みを返す。失敗時は None（キャッシュを使わずに続行）。"""
+    try:
+        resp = await _client.embeddings.create(model=OPENAI_EMBEDDING_MODEL, input=text)
+    except Exception as e:
+        logger.warning("Embedding call failed, skipping semantic cache: %s", e)
+        return None
+    return resp.data[0].embedding
+
+@alru_cache(maxsize=cache.CACHE_SIZE, ttl=cache.CACHE_TTL)
+async def _search_items_cached(prefecture, municipality, industry, keywords, top_k):
+    """完全一致キャッシュ（同一条件の同時リクエストも1回の呼び出しにまとまる）。
+
+    ミス時はディスクキャッシュ（コールドスタート後も残る）、次にキーワード以外の条件が同じで
+    キーワードの意味が近い過去の結果を探し、それも無ければ OpenAI を呼ぶ。
+    返り値は正規化済みの GrantItem のリスト。
+    """
+    req = SearchRequest(
+        prefecture=prefecture, municipality=municipality, industry=industry,
+        keywords=keywords, top_k=top_k,
+    )
+    disk_key = cache.request_key({
+        "req": req.model_dump(), "model": OPENAI_MODEL, "version": _RESULT_CACHE_VERSION,
+    })
+    stored = await cache.disk_get(disk_key)
+    if stored:
+        return [GrantItem.model_validate(i) for i in stored]
+
+    key = (prefecture, municipality, industry, keywords, top_k)
+    partition = (prefecture, municipality, industry, top_k)
+    vec = None
+    if keywords and cache.SEMANTIC_ENABLED and _client is not None:
+        vec = await embed_text(keywords)
+        if vec is not None:
+            hit = cache.semantic_lookup(partition, vec)
+            if hit is not None:
+                return hit
+
+    items = await _batcher.submit(req)
+    if items:
+        await cache.disk_set(disk_key, [i.model_dump() for i in items])
+        if vec is not None:
+            cache.semantic_store(key, partition, vec, items)
+    return items
+
+async def search_items(req: SearchRequest):
+    key = (req.prefecture, req.municipality, req.industry, req.keywords, req.top_k)
+    items = await _search_items_cached(*key)
+    if not items:
+        # 空の結果（モデル出力のパース失敗など）はキャッシュに残さない
+        _search_items_cached.cache_invalidate(*key)
+    return items
+
 # ========= ルート =========
 @app.get("/healthz")
 async def health():
@@ -215,7 +495,18 @@ async def health():
 @app.post("/v1/search", response_model=SearchResponse)
 async def search(req: SearchRequest):
     t0 = time.time()
-    items_raw = await call_openai(build_prompt(req), req.top_k)
-    # Pydanticで検証しつつ整形
-    items = [GrantItem(**i) for i in items_raw]
-    return SearchResponse(items=items, took_ms=int((time.time() - t0) * 1000))
+    # normalize_and_filter_items が検証済みの GrantItem を返すため再検証は省略（出力は response_model）
+    items = await search_items(req)
+    return SearchResponse.model_construct(items=items, took_ms=int((time.time() - t0) * 1000))
+
+@app.post("/v1/search/stream")
+async def search_stream(req: SearchRequest):
+    """/v1/search と同じ条件で、見つかった GrantItem を1行1件の NDJSON で逐次返す。"""
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=500, detail="OPENAI_API_KEY is not set")
+
+    async def body():
+        async for item in stream_openai(build_prompt(req), req.top_k):
+            yield item.model_dump_json().encode() + b"\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
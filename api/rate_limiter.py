@@ -1,35 +1,47 @@
 import time
 import threading
 import os
-from collections import deque
+import logging
 from typing import Tuple
 
+import redis.asyncio as redis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+
+logger = logging.getLogger(__name__)
+
 
 class SimpleSlidingWindow:
     """グローバル（全体）カウントのスライディングウィンドウ実装。
 
-    全リクエストを1つの deque に格納して、過去 60 秒間の全リクエスト数をカウントします。
+    1 秒ごとのバケットを 60 個のリングに持ち、過去 60 秒間のバケットの合計で全リクエスト数を
+    数えます。時刻は time.monotonic() を使うため壁時計の変更の影響を受けません。
     非常にシンプルで単一プロセス向けです。
     """
 
     def __init__(self, per_min: int):
         self.per_min = int(per_min)
         self.window_seconds = 60
-        self.deque = deque()
+        self.buckets = [0] * self.window_seconds
+        # 各バケットが何秒目のカウントを保持しているか（リングの再利用時にリセット判定に使う）
+        self.bucket_ts = [-self.window_seconds] * self.window_seconds
         self.lock = threading.Lock()
 
     def allow(self) -> Tuple[bool, int]:
         """全体のリクエストを許可するか判定する。戻り値は (allowed, remaining)。"""
-        now = time.time()
-        cutoff = now - self.window_seconds
+        sec = int(time.monotonic())
+        idx = sec % self.window_seconds
+        cutoff = sec - self.window_seconds
         with self.lock:
-            # 古いタイムスタンプを削除
-            while self.deque and self.deque[0] <= cutoff:
-                self.deque.popleft()
+            # 60 秒前のカウントが残っているバケットを今の秒用にリセット
+            if self.bucket_ts[idx] != sec:
+                self.bucket_ts[idx] = sec
+                self.buckets[idx] = 0
 
-            if len(self.deque) < self.per_min:
-                self.deque.append(now)
-                remaining = self.per_min - len(self.deque)
+            total = sum(n for n, ts in zip(self.buckets, self.bucket_ts) if ts > cutoff)
+            if total < self.per_min:
+                self.buckets[idx] += 1
+                remaining = self.per_min - total - 1
                 return True, remaining
             else:
                 return False, 0
@@ -39,7 +51,45 @@ class SimpleSlidingWindow:
 _PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "60"))
 _limiter = SimpleSlidingWindow(_PER_MIN)
 
+# REDIS_URL があれば全ワーカー/インスタンスで共有する Redis でカウントする（接続は初回使用時）。
+# 全リクエストが通る経路なので、タイムアウトは短くし、クライアント内での再試行もしない。
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.2"))
+# Redis エラー後、この秒数はプロセス内のカウントだけを使い再接続を試みない
+REDIS_BACKOFF_SECONDS = float(os.getenv("REDIS_BACKOFF_SECONDS", "5"))
+_redis = redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT,
+    socket_timeout=REDIS_TIMEOUT,
+    retry=Retry(NoBackoff(), 0),
+) if REDIS_URL else None
+_redis_retry_at = 0.0
+
+
+async def _allow_redis() -> Tuple[bool, int]:
+    """分単位の固定ウィンドウを INCR + EXPIRE（1 往復のパイプライン）でカウントする。"""
+    key = f"rl:global:{int(time.time() // 60)}"
+    pipe = _redis.pipeline(transaction=False)
+    pipe.incr(key)
+    pipe.expire(key, 120)
+    n, _ = await pipe.execute()
+    return n <= _PER_MIN, max(0, _PER_MIN - n)
 
-def allow_request(_: str = "global") -> Tuple[bool, int]:
-    """引数は無視される（互換性のために ip を取るが、内部はグローバルカウントを使用）。"""
+
+async def allow_request(_: str = "global") -> Tuple[bool, int]:
+    """引数は無視される（互換性のために ip を取るが、内部はグローバルカウントを使用）。
+
+    Redis が設定されていればそちらを使い、エラー時は REDIS_BACKOFF_SECONDS の間
+    プロセス内のカウントにフォールバックする。
+    """
+    global _redis_retry_at
+    if _redis is not None and time.monotonic() >= _redis_retry_at:
+        try:
+            return await _allow_redis()
+        except redis.RedisError as e:
+            _redis_retry_at = time.monotonic() + REDIS_BACKOFF_SECONDS
+            logger.warning(
+                "Redis rate limiter unavailable, falling back to in-process for %.0fs: %s",
+                REDIS_BACKOFF_SECONDS, e,
+            )
     return _limiter.allow()
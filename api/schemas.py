@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional, List
 from enum import Enum
 
@@ -16,6 +16,18 @@ class SearchRequest(BaseModel):
     top_k: int = Field(10, ge=1, le=20, description="返却件数")
 
 
+def _to_ratio(v) -> Optional[float]:
+    """[0, 1] の比率に変換する。(1, 100] はパーセント表記とみなして 100 で割り、範囲外・不正値は None。"""
+    if isinstance(v, str):
+        try:
+            v = float(v.replace(",", "").strip())
+        except ValueError:
+            return None
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or not 0 <= v <= 100:
+        return None
+    return v / 100 if v > 1 else float(v)
+
+
 class GrantItem(BaseModel):
     title: str
     summary: str
@@ -30,6 +42,24 @@ class GrantItem(BaseModel):
     confidence: float = Field(0.0, ge=0.0, le=1.0)
     reasons: List[str] = Field(default_factory=list)
 
+    @field_validator("rate_max", mode="before")
+    @classmethod
+    def _rate_ratio(cls, v):
+        return _to_ratio(v)
+
+    @field_validator("confidence", mode="before")
+    @classmethod
+    def _confidence_ratio(cls, v):
+        # 0・欠落・不正値は信頼度のフォールバック値（0.2）にする
+        return _to_ratio(v) or 0.2
+
+    @field_validator("reasons", mode="before")
+    @classmethod
+    def _reasons_list(cls, v):
+        if v is None:
+            return []
+        return [v] if isinstance(v, str) else v
+
 
 class SearchResponse(BaseModel):
     items: List[GrantItem]
@@ -1,128 +1,246 @@
 import re
-import json
 import logging
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
+
+import orjson
+from pydantic import ValidationError
+
+from .schemas import GrantType, GrantItem
+
+logger = logging.getLogger(__name__)
+
+
+# コードフェンス（```json ... ``` / ``` ... ```）内の JSON を取り出すパターン
+_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.S | re.I)
+# 文字列の外で括弧の対応付けに意味を持つ文字（括弧・クォート）だけを拾うパターン
+_STRUCTURAL_RE = re.compile(r'[{}\[\]"]')
+
+
+def _find_string_end(t: str, pos: int, str_start: int) -> int:
+    """str_start から始まる JSON 文字列の閉じクォートを pos 以降から探します（無ければ -1）。
+
+    文字列の中身は 1 文字ずつ見ずに str.find で次の '"' まで飛び、直前に連続する
+    バックスラッシュが奇数個（エスケープされたクォート）の場合だけ探索を続けます。
+    """
+    while True:
+        k = t.find('"', pos)
+        if k < 0:
+            return -1
+        b = k - 1
+        while b >= str_start and t[b] == "\\":
+            b -= 1
+        if (k - 1 - b) % 2 == 0:
+            return k
+        pos = k + 1
+
+
+def _scan_json_bounds(t: str, start: int) -> int:
+    """t[start] の '{' / '[' に対応する閉じ括弧の位置を返します（見つからなければ -1）。
+
+    1 文字ずつ Python でループする代わりに、文字列外の構造文字だけを正規表現で拾い、
+    文字列の中身は _find_string_end で読み飛ばすため、ループは構造文字の数しか回りません。
+    """
+    stack = []
+    pos = start
+    while True:
+        m = _STRUCTURAL_RE.search(t, pos)
+        if not m:
+            return -1
+        i = m.start()
+        ch = m.group()
+        pos = i + 1
+        if ch == '"':
+            # 文字列内ではエスケープを考慮して終了のクォートを判断
+            end = _find_string_end(t, pos, pos)
+            if end < 0:
+                return -1
+            pos = end + 1
+        elif ch == '{':
+            stack.append('}')
+        elif ch == '[':
+            stack.append(']')
+        elif stack and ch == stack[-1]:
+            stack.pop()
+            if not stack:
+                return i
 
 
 def extract_json_from_text(t: str) -> Any:
     """モデルの出力テキストから JSON オブジェクトまたは配列を抽出して返します。
 
     手順:
-    1) まず ```json ... ``` や ``` ... ``` といったコードフェンス内の JSON を優先して試します。
-    2) それが見つからない場合、テキスト内で最初に現れる '{' または '[' から開始して
+    1) テキストが '{' か '[' で始まる場合、全体をそのまま JSON としてパースできればそれを返します。
+    2) 次に ```json ... ``` や ``` ... ``` といったコードフェンス内の JSON を試します。
+    3) それでも見つからない場合、テキスト内で最初に現れる '{' または '[' から開始して
        括弧の対応を取ることで JSON の範囲を切り出します。文字列中のエスケープも考慮します。
 
-    パースに成功すれば Python のデータ（dict または list）を返し、失敗すれば None を返します。
+    パースには orjson を使います。成功すれば Python のデータ（dict または list）を返し、
+    失敗すれば None を返します。
     """
     if not t:
         return None
 
-    # 1) コードフェンス内の JSON を優先して取り出す
-    m = re.search(r"```(?:json)?\s*(.*?)\s*```", t, re.S | re.I)
+    # 1) 出力全体が JSON の場合（最も多いケース）。先頭が '{' / '[' のときだけ試す
+    t2 = t.lstrip()
+    if t2 and t2[0] in "{[":
+        try:
+            return orjson.loads(t2)
+        except orjson.JSONDecodeError:
+            pass
+
+    # 2) コードフェンス内の JSON を優先して取り出す
+    m = _FENCE_RE.search(t)
     if m:
-        candidate = m.group(1).strip()
         try:
-            return json.loads(candidate)
-        except Exception:
+            return orjson.loads(m.group(1))
+        except orjson.JSONDecodeError:
             # フェンス内でも JSON でなければフォールバックする
             pass
 
-    # 2) 最初の { または [ から括弧の対応を見て JSON 範囲を切り出す
-    start = None
-    for i, ch in enumerate(t):
-        if ch in "{[":
-            start = i
-            break
-    if start is None:
+    # 3) 最初の { または [ から括弧の対応を見て JSON 範囲を切り出す
+    starts = [i for i in (t.find("{"), t.find("[")) if i >= 0]
+    if not starts:
         return None
+    start = min(starts)
+
+    end = _scan_json_bounds(t, start)
+    if end < 0:
+        return None
+    try:
+        return orjson.loads(t[start: end + 1])
+    except orjson.JSONDecodeError:
+        # 切り出した範囲が正しい JSON でない場合は None を返す
+        return None
+
+
+class IncrementalItemParser:
+    """ストリーミング中のモデル出力から、items 配列の要素（オブジェクト）を閉じた順に取り出します。
+
+    feed() のたびに前回の走査位置から再開し、括弧の深さ・文字列内かどうかの状態を引き継ぐため、
+    受信済みのテキストを先頭から再スキャンしません。{"items": [...]} 形式と素の配列 [...] の
+    両方に対応し、JSON 開始前の前置き（コードフェンスなど）は読み飛ばします。
+    """
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.stack = []
+        self.str_start = -1  # 文字列の途中で止まっている場合、その中身の開始位置
+        self.item_start = -1
+
+    def _at_item_level(self) -> bool:
+        # ルートの配列直下、またはルートのオブジェクト内の配列直下
+        return self.stack == [']'] or self.stack == ['}', ']']
+
+    def feed(self, delta: str) -> List[Any]:
+        """受信したテキスト片を追加し、新たに閉じた要素を Python のデータとして返します。"""
+        self.buf += delta
+        buf = self.buf
+        out = []
+        while True:
+            if self.str_start >= 0:
+                end = _find_string_end(buf, self.pos, self.str_start)
+                if end < 0:
+                    # 閉じクォートが未着。次の feed で続きから探す
+                    self.pos = len(buf)
+                    break
+                self.str_start = -1
+                self.pos = end + 1
+                continue
+            m = _STRUCTURAL_RE.search(buf, self.pos)
+            if not m:
+                self.pos = len(buf)
+                break
+            i = m.start()
+            ch = m.group()
+            self.pos = i + 1
+            if not self.stack and ch not in "{[":
+                continue
+            if ch == '"':
+                self.str_start = self.pos
+            elif ch == '{' or ch == '[':
+                if ch == '{' and self._at_item_level():
+                    self.item_start = i
+                self.stack.append('}' if ch == '{' else ']')
+            elif self.stack and ch == self.stack[-1]:
+                self.stack.pop()
+                if ch == '}' and self.item_start >= 0 and self._at_item_level():
+                    try:
+                        out.append(orjson.loads(buf[self.item_start: i + 1]))
+                    except orjson.JSONDecodeError:
+                        pass
+                    self.item_start = -1
+        return out
 
-    stack = []
-    in_str = False
-    esc = False
-    for i in range(start, len(t)):
-        ch = t[i]
-        if in_str:
-            # 文字列内ではエスケープを考慮して終了のクォートを判断
-            if esc:
-                esc = False
-            elif ch == "\\":
-                esc = True
-            elif ch == '"':
-                in_str = False
-            continue
-        if ch == '"':
-            in_str = True
-            continue
-        if ch == '{':
-            stack.append('}')
-        elif ch == '[':
-            stack.append(']')
-        elif stack and ch == stack[-1]:
-            stack.pop()
-            if not stack:
-                candidate = t[start: i + 1]
-                try:
-                    return json.loads(candidate)
-                except Exception:
-                    # 切り出した範囲が正しい JSON でない場合は None を返す
-                    return None
-    return None
 
+def normalize_item(i: Dict) -> Dict:
+    """1 件の項目のキー名の揺れを吸収し、GrantItem に渡す dict に正規化します。
 
-def normalize_and_filter_items(items: List[Dict], top_k: int) -> List[Dict]:
+    型変換・範囲の補正（confidence / rate_max のパーセント表記、confidence のフォールバック 0.2 など）は
+    GrantItem の検証で行うため、ここではキー名の統一と grant_type の補完だけを行います。
+    """
+    g = i.get
+    title = g("title") or g("name") or ""
+
+    # grant_type を GrantType に変換。無い/不正な値ならタイトルの語を見て補完
+    try:
+        grant_type = GrantType(g("grant_type"))
+    except ValueError:
+        if isinstance(title, str) and "助成金" in title and "補助金" not in title:
+            grant_type = GrantType.GRANT
+        else:
+            grant_type = GrantType.SUBSIDY
+
+    return {
+        "title": title,
+        "summary": g("summary") or g("description") or "",
+        "source_url": g("source_url") or g("url") or g("link") or "",
+        "grant_type": grant_type,
+        "deadline": g("deadline"),
+        "amount_max": g("amount_max"),
+        "rate_max": g("rate_max"),
+        "area": g("area"),
+        "municipality": g("municipality"),
+        "industry": g("industry"),
+        "confidence": g("confidence"),
+        "reasons": g("reasons"),
+    }
+
+
+def to_grant_item(n: Dict) -> Optional[GrantItem]:
+    """正規化済みの dict を GrantItem.model_validate で検証して返します。
+
+    変換できないフィールドがあれば、そのフィールドだけを外して（既定値にして）もう一度検証し、
+    それでも通らなければ None を返します。
+    """
+    try:
+        return GrantItem.model_validate(n)
+    except ValidationError as e:
+        bad = {err["loc"][0] for err in e.errors() if err["loc"]}
+    try:
+        return GrantItem.model_validate({k: v for k, v in n.items() if k not in bad})
+    except ValidationError as e:
+        logger.warning("Dropping item that failed validation: %s", e)
+        return None
+
+
+def normalize_and_filter_items(items: List[Dict], top_k: int) -> List[GrantItem]:
     """API の GrantItem 形式に合わせて項目を正規化し、フィルタ／フォールバックを適用します。
 
+    型変換は GrantItem.model_validate（to_grant_item）の 1 回だけに任せ、検証に通らない項目は除外します。
+    以降（キャッシュ・レスポンス）は検証済みのインスタンスをそのまま使います。
+
     主な処理:
-    - grant_type が無ければ title から補助金/助成金を推定（無ければ補助金をデフォルト）
-    - title, summary, source_url 等のキー名の揺れを吸収して正規化
+    - grant_type を GrantType に変換。無い/不正な値なら title から補助金/助成金を推定（無ければ補助金をデフォルト）
+    - title, summary, source_url 等のキー名の揺れを吸収して正規化し、GrantItem として検証
     - source_url が空のエントリは除外（全件除外になる場合は除外しない）
     - confidence が 0 または欠落している場合のフォールバック値を設定（0.2）
     - top_k による切り詰め
     """
-    def normalize_item(i: Dict) -> Dict:
-        # grant_type の補完（タイトルの語を見て判定）
-        grant_type = i.get("grant_type")
-        if not grant_type:
-            title = (i.get("title") or "").lower()
-            if "補助金" in title:
-                grant_type = "補助金"
-            elif "助成金" in title:
-                grant_type = "助成金"
-            else:
-                grant_type = "補助金"
-
-        normalized = {
-            "title": i.get("title") or i.get("name") or "",
-            "summary": i.get("summary") or i.get("description") or "",
-            "source_url": i.get("source_url") or i.get("url") or i.get("link") or "",
-            "grant_type": grant_type,
-            "deadline": i.get("deadline") if i.get("deadline") is not None else None,
-            "amount_max": i.get("amount_max") if i.get("amount_max") is not None else None,
-            "rate_max": i.get("rate_max") if i.get("rate_max") is not None else None,
-            "area": i.get("area") if i.get("area") is not None else None,
-            "municipality": i.get("municipality") if i.get("municipality") is not None else None,
-            "industry": i.get("industry") if i.get("industry") is not None else None,
-            "confidence": float(i.get("confidence", 0.0)) if i.get("confidence") is not None else 0.0,
-            "reasons": i.get("reasons") or [],
-        }
-        return normalized
-
     # 正規化して上位 top_k 件に切り詰め
-    normalized = [normalize_item(it) for it in items]
-    normalized = normalized[:top_k]
+    normalized = [normalize_item(it) for it in items[:top_k]]
 
     # source_url が空のものを除外。ただし全件除外になる場合は元のリストを使う
-    filtered = [it for it in normalized if it.get("source_url")]
-    if not filtered:
-        filtered = normalized
-
-    # confidence が 0 の場合は信頼度のフォールバック値を設定
-    for it in filtered:
-        try:
-            conf = float(it.get("confidence", 0.0))
-        except Exception:
-            conf = 0.0
-        if conf == 0.0:
-            it["confidence"] = 0.2
+    filtered = [it for it in normalized if it["source_url"]] or normalized
 
-    return filtered
+    return [item for item in map(to_grant_item, filtered) if item is not None]